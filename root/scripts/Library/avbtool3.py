@@ -3112,12 +3112,16 @@ class Avb(object):
           salt = ''
 
       hasher = hashlib.new(name=hash_algorithm)
-      # TODO(zeuthen): might want to read this in chunks to avoid
-      # memory pressure, then again, this is only supposed to be used
-      # on kernel/initramfs partitions. Possible optimization.
+      # Read in chunks to avoid holding the whole partition in memory.
       image.seek(0)
       hasher.update(salt)
-      hasher.update(image.read(image.image_size))
+      to_go = image.image_size
+      while to_go > 0:
+        data = image.read(min(to_go, 1 << 20))
+        if not data:
+          break
+        hasher.update(data)
+        to_go -= len(data)
       digest = hasher.digest()
 
       h_desc = AvbHashDescriptor()
@@ -7,6 +7,7 @@ from Crypto.PublicKey import RSA
 from .avbtool3 import *
 import os
 import stat
+from concurrent.futures import ThreadPoolExecutor
 
 # !/usr/bin/python3
 # -*- coding: utf-8 -*-
@@ -208,6 +209,15 @@ def run_command(cmd):
     os.system(cmd)
 
 
+# created at import, so threads signing several images can't each create their own pool
+_command_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def run_command_async(cmd):
+    # same as run_command, but returns a Future so independent commands can overlap
+    return _command_pool.submit(os.system, cmd)
+
+
 class androidboot:
     magic = "ANDROID!"  # BOOT_MAGIC_SIZE 8
     kernel_size = 0
@@ -408,9 +418,16 @@ def extract_key(modulus, tmpdir):
                                     url = data["filename"]
                                     filename = url[url.rfind("/") + 1:]
                                     filename = os.path.join(tmpdir, filename)
-                                    with open(filename, "wb") as wf:
-                                        wf.write(base64.b64decode(content))
-                                        return filename
+                                    key = base64.b64decode(content)
+                                    if os.path.exists(filename):
+                                        with open(filename, "rb") as rf:
+                                            if rf.read() == key:
+                                                # keep the mtime, so keys derived from it stay up to date
+                                                return filename
+                                    with open(filename + ".tmp", "wb") as wf:
+                                        wf.write(key)
+                                    os.replace(filename + ".tmp", filename)
+                                    return filename
     return None
 
 